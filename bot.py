@@ -1,4 +1,6 @@
-import os, logging, re
+import os, sys, logging, asyncio
+from collections import defaultdict
+from decimal import Decimal
 from dotenv import load_dotenv
 
 from telegram import Update
@@ -10,78 +12,114 @@ from telegram.ext import (
   filters,
 )
 
+# Largest number of unsettled people for which the fewest-transactions search runs;
+# it is exponential in this, past it settlement falls back to plain netting
+_MAX_EXACT_SETTLEMENT = 15
+
+# Largest amount a single /add accepts
+_MAX_AMOUNT = Decimal('1000000')
+
+# Static reply for /help, assembled once at import
+_SEPARATOR = "=====================================\n"
+_HELP_TEXT = (
+    "Here are all the commands available! Commands without any examples can be used as is, the other more complicated ones will be shown!\n\n"
+    + _SEPARATOR
+    + "/include: Add users to be included in the receipt (as many as you want!). Always start with this!\n\ne.g.\nJohn, Adam and Sally agreed to share costs\n/include @john @adam @sally\n"
+    + _SEPARATOR
+    + "/add: Add expense. Names can be added at the end to specify that it is to be split amongst them.\n\ne.g.\nJohn paid $10, to be split amongst everyone\n/add John 10\n\nJohn paid $10, and the cost is to be split among John and Adam\n/add @john 10 @adam\n"
+    + _SEPARATOR
+    + "/view: Displays all expenses\n"
+    + _SEPARATOR
+    + "/resolve: Displays which individual needs to pay who\n"
+    + _SEPARATOR
+    + "/clear: Clears all records\n"
+    + _SEPARATOR
+    + "\n*Note: When encountering an error, please re-enter the instruction and not edit the previous one.\n\n"
+    + "Made by @nelthm"
+)
+
 # Define custom class for chat_data
 class ChatData:
+    # One instance lives per chat, so skip the per-instance __dict__
+    __slots__ = ('expenditure', 'shared_expenditure', '_total', '_dirty', '_cached_transactions')
+
     def __init__(self) -> None:
-        self.users = list()
-        self.expenditure = dict()
-        self.shared_expenditure = dict()
+        # All amounts are whole cents
+        self.expenditure = defaultdict(int)
+        self.shared_expenditure = list() # [(creditor, debtors, value), ...]
+        self._total = 0 # running sum of self.expenditure
+        self._dirty = True # whether _cached_transactions is stale
+        self._cached_transactions = None
 
     def clear(self) -> None:
-        self.users.clear()
         self.expenditure.clear()
         self.shared_expenditure.clear()
+        self._total = 0
+        self._dirty = True
 
     def include(self, users) -> None:
-        self.users = users
+        # Interned so repeated handles share one string and dict probes hit the identity check
         for user in users:
-            self.expenditure[user] = 0.0
+            self.expenditure.setdefault(sys.intern(user), 0)
+        self._dirty = True
     
-    def update_expenditure(self, key: str, value: float, others: list = None):
+    def update_expenditure(self, key: str, value: int, others: list = None):
+        key = sys.intern(key)
         if others is None:
-            p_value = self.expenditure.get(key, 0)
-            self.expenditure[key] = p_value + value
-        else: # self.shared_expenditure = {creditor: {debtors: value, debtors1: value}}
-            debtor_value_dict = self.shared_expenditure.get(key, {})  # gets dict of debtors and values
-            debtor_value_dict[frozenset(others)] = debtor_value_dict.get(frozenset(others), 0) + value # gets value and increment
-            self.shared_expenditure[key] = debtor_value_dict
-    
-    def avg_expenditure(self) -> float: 
-        try:
-            # Excludes special expenditure
-            total_expenditure = sum(self.expenditure.values())
-            num_people = len(self.expenditure)
-            return total_expenditure/num_people
-        except ZeroDivisionError:
-            return 0
+            self.expenditure[key] += value
+            self._total += value
+        else:
+            # Ordered and de-duplicated, so /view lists debtors as they were entered
+            debtors = tuple(dict.fromkeys(map(sys.intern, others)))
+            self.shared_expenditure.append((key, debtors, value))
+        self._dirty = True
     
     def resolve_expenses(self) -> list:
-        avg_expenditure = self.avg_expenditure()
-
-        debts = {person: expense - avg_expenditure for person, expense in self.expenditure.items()}
-
-        # Account for special expenditures
-        for creditor, debtor_value_dict in self.shared_expenditure.items():
-            for debtors, value in debtor_value_dict.items():
-                shared_expense = value / (len(debtors) + 1)
-                creditor_balance = debts.get(creditor, 0)
-                debts[creditor] = creditor_balance + shared_expense
-
-                for debtor in debtors:
-                    debtor_balance = debts.get(debtor, 0)
-                    debts[debtor] = debtor_balance - shared_expense
-
-        creditors = {person: expense for person, expense in debts.items() if expense > 0}
-        debtors = {person: expense for person, expense in debts.items() if expense < 0}
+        if self._dirty:
+            self._cached_transactions = self._settle()
+            self._dirty = False
+        return self._cached_transactions
+
+    def _settle(self) -> list:
+        if not self.expenditure:
+            return []
+
+        # Parallel arrays of names and balances, indexed once per resolve. Balances start as
+        # what each person paid less their cut of the even split (excluding special expenditure);
+        # cents that don't divide evenly go to the first few people
+        names = list(self.expenditure)
+        index = {person: i for i, person in enumerate(names)}
+        share, remainder = divmod(self._total, len(names))
+        balances = [expense - share - (i < remainder) for i, expense in enumerate(self.expenditure.values())]
+
+        # Account for special expenditures, payer first in line for any indivisible cents
+        for creditor, debtors, value in self.shared_expenditure:
+            shared_expense, remainder = divmod(value, len(debtors) + 1)
+            balances[index[creditor]] += value - shared_expense - (remainder > 0)
+
+            for i, debtor in enumerate(debtors, 1):
+                balances[index[debtor]] -= shared_expense + (i < remainder)
+
+        # Only people with an outstanding balance take part in settling
+        people = list()
+        amounts = list()
+        for i, balance in enumerate(balances):
+            if balance:
+                people.append(i)
+                amounts.append(balance)
+        if not people:
+            return []
+
+        # Fewest transactions: split into as many zero-sum groups as possible and net each one on its own
+        if len(amounts) <= _MAX_EXACT_SETTLEMENT:
+            groups = zero_sum_groups(amounts)
+        else:
+            groups = [list(range(len(amounts)))]
 
         transactions = list()
-
-        for debtor, debtor_amount in debtors.items():
-          for creditor, creditor_amount in creditors.items():
-              if debtor_amount == 0:
-                  break
-              if creditor_amount == 0:
-                  continue
-
-              # Determine the amount to transfer
-              transfer_amount = min(-debtor_amount, creditor_amount)
-
-              # Update the balances
-              debtors[debtor] += transfer_amount
-              creditors[creditor] -= transfer_amount
-
-              # Record the transaction
-              transactions.append((debtor, creditor, transfer_amount))
+        for group in groups:
+            for debtor, creditor, amount in net_balances([amounts[i] for i in group]):
+                transactions.append((names[people[group[debtor]]], names[people[group[creditor]]], amount))
 
         return transactions
     
@@ -90,9 +128,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Displays salutation and clears all previous records
     Usage: /start
     """
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="""I'm SplitLaterBot, here to help calculate who you should pay after a group evening out!\n\nType /help to view all commands"""
+    await update.message.reply_text(
+        """I'm SplitLaterBot, here to help calculate who you should pay after a group evening out!\n\nType /help to view all commands"""
     )
 
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -110,31 +147,16 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Displays all commands and their usages
     Usage: /help
     """
-    preamble = "Here are all the commands available! Commands without any examples can be used as is, the other more complicated ones will be shown!\n\n"
-    # start_message = "/start: Restarts the session and clears all previous record\nUsage: /start\n\n"
-    # help_message = "/help: Displays all commands\nUsage: /help\n\n"
-    include_message = "/include: Add users to be included in the receipt (as many as you want!). Always start with this!\n\ne.g.\nJohn, Adam and Sally agreed to share costs\n/include @john @adam @sally\n"
-    add_message = "/add: Add expense. Names can be added at the end to specify that it is to be split amongst them.\n\ne.g.\nJohn paid $10, to be split amongst everyone\n/add John 10\n\nJohn paid $10, and the cost is to be split among John and Adam\n/add @john 10 @adam\n"
-    view_message = "/view: Displays all expenses\n"
-    resolve_message = "/resolve: Displays which individual needs to pay who\n"
-    clear_message = "/clear: Clears all records\n"
-    note_message = "\n*Note: When encountering an error, please re-enter the instruction and not edit the previous one.\n\n"
-    credits = "Made by @nelthm"
-    separator = "=====================================\n"
-
-    await update.message.reply_text(
-        f"{preamble}{separator}{include_message}{separator}{add_message}{separator}{view_message}{separator}{resolve_message}{separator}{clear_message}{separator}{note_message}{credits}"
-    )
+    await update.message.reply_text(_HELP_TEXT)
 
 async def include(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Initializes all included users to zero
+    Adds users to the receipt, starting newly included ones at zero
     Usage: /include @user1 @user2
     """
-    users = ' '.join(context.args)
     num_users = len(context.args)
 
-    if include_regex(num_users, users):
+    if context.args and all(map(is_handle, context.args)):
         context.chat_data.include(context.args)
         await update.message.reply_text(f"Alright! We detected {num_users}. You may now add transactions via the add command!")
     else:
@@ -146,50 +168,14 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Usage: /add @person value *
     Example: /add @john 10 @other
     """
-    if len(context.chat_data.users) == 0:
-        await update.message.reply_text("Error: Please use the /include command to add users first!")
+    try:
+        person, value, others = parse_add(context.args, context.chat_data.expenditure)
+    except AddError as error:
+        await update.message.reply_text(str(error))
         return
 
-    others = None
-    if len(context.args) > 2:
-        try:
-            person_value = ' '.join(context.args[0:2])
-            person = context.args[0]
-            value = context.args[1]            
-            others = context.args[2:]
-            if not add_regex(person_value) or not include_regex(len(others), ' '.join(others)):
-                raise Exception
-            if person not in context.chat_data.users:
-                raise Exception
-            
-            for user in others:
-                if user not in context.chat_data.users:
-                    raise Exception
-                
-        except:
-            await update.message.reply_text("Error: the format should be '/add @name value @other1 @other2...'. Only specify users you've added using /include!")
-            return
-    else:
-        try:
-            person_value = ' '.join(context.args[0:2])
-            person = context.args[0]
-            value = context.args[-1]
-            if not add_regex(person_value):
-                raise Exception
-            
-            if person not in context.chat_data.users:
-                raise Exception
-
-        except: # User enters < and > 2 arguments
-            await update.message.reply_text("Error: the format should be '/add @name value @other_name'. Only specify users you've added using /include!")
-            return
-
-    try:
-        context.chat_data.update_expenditure(person, float(value), others)
-        await update.message.reply_text("Added!")
-    except ValueError: # non-numeric value found as expense argument
-        await update.message.reply_text("Error: non-numeric value for expense found.")
-        pass
+    context.chat_data.update_expenditure(person, value, others)
+    await update.message.reply_text("Added!")
 
 async def view(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -197,25 +183,21 @@ async def view(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Usage: /view
     """
     equal_preamble = 'Expenses intended to split equally:\n'
-    equal_message = ''
-    for person, expense in context.chat_data.expenditure.items():
-        equal_message += f"{person} has paid {expense}\n"
-    
+    equal_message = ''.join(f"{person} has paid {expense / 100:.2f}\n" for person, expense in context.chat_data.expenditure.items())
+
     special_preamble = 'Expenses intended to split amongst certain individuals:\n'
-    special_message = ''
-    for creditor, debtor_value_dict in context.chat_data.shared_expenditure.items():
-        for debtors, value in debtor_value_dict.items():
-            debtors = ', '.join(debtors)
-            special_message += f'{creditor} paid {value} to be shared with {debtors}\n'
-
-    if equal_message != '' and special_message != '':
-        await update.message.reply_text(f"{equal_preamble}{equal_message}\n\n{special_preamble}{special_message}")
-    elif equal_message != '' and special_message == '':
-        await update.message.reply_text(f"{equal_preamble}{equal_message}\n\n{special_preamble}None")
-    elif equal_message == '' and special_message != '':
-        await update.message.reply_text(f"{equal_preamble}None\n\n{special_preamble}{special_message}")
-    else:
+    special_message = ''.join(
+        f"{creditor} paid {value / 100:.2f} to be shared with {', '.join(debtors)}\n"
+        for creditor, debtors, value in context.chat_data.shared_expenditure
+    )
+
+    if equal_message == '' and special_message == '':
         await update.message.reply_text(f"No records have been added!")
+        return
+
+    message = f"{equal_preamble}{equal_message or 'None'}\n\n{special_preamble}{special_message or 'None'}"
+    for chunk in chunk_message(message):
+        await update.message.reply_text(chunk)
 
 
 async def resolve(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -223,38 +205,146 @@ async def resolve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Resolves all expenditures and splits among persons
     Usage: /resolve
     """
-    try:
-      transactions = context.chat_data.resolve_expenses()
-      message = ''
-      for debtor, creditor, amount in transactions:
-        string = f"{debtor} pays {creditor} ${amount:.2f}\n"
-        message += string
-      
-      await update.message.reply_text(message)
-    except:
+    transactions = context.chat_data.resolve_expenses()
+    if not transactions:
         await update.message.reply_text(f"Either no individuals added, no expenses added, or everyone has spent equal amounts.")
+        return
+
+    message = '\n'.join(f"{debtor} pays {creditor} ${amount / 100:.2f}" for debtor, creditor, amount in transactions)
+    # Transactions are independent of each other, so the pieces can be sent in parallel
+    await asyncio.gather(*(update.message.reply_text(chunk) for chunk in chunk_message(message)))
 
 
 async def _unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Internal use for unknown command handling
     """
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="Error: Either a wrong command has been entered, or a previous message has been edited.\nPlease retype rather than editing the previous message :)")
+    await update.effective_chat.send_message("Error: Either a wrong command has been entered, or a previous message has been edited.\nPlease retype rather than editing the previous message :)")
 
 
 # ================= HELPER FUNCTIONS =================
     
-def include_regex(num_handles: int, users: str) -> bool:
-    # The regex pattern for a Telegram handle
-    handle_pattern = r'@[\w\d_]+'
-    full_pattern = fr'{handle_pattern}(\s{handle_pattern}){{{num_handles - 1}}}'
-
-    return re.fullmatch(full_pattern, users)
-
-def add_regex(args: str) -> bool:
-    # Regex pattern for @user numeral
-    handle_pattern = r'@(\S+)\s+(\d+)$'
-    return re.fullmatch(handle_pattern, args)
+def is_handle(token: str) -> bool:
+    # A Telegram handle: "@" followed by letters, digits and underscores, not starting with a digit
+    return token.startswith('@') and token[1:].isidentifier()
+
+def is_amount(token: str) -> bool:
+    # A non-negative amount with at most one decimal point
+    return token.replace('.', '', 1).isdecimal()
+
+def net_balances(balances: list) -> list:
+    # Two-pointer netting over signed balances, largest first. Works on indices only so it
+    # stays a plain numeric loop; returns (debtor index, creditor index, amount) triples
+    creditors = list()
+    debtors = list()
+    for i, balance in enumerate(balances):
+        if balance > 0:
+            creditors.append(i)
+        elif balance < 0:
+            debtors.append(i)
+    creditors.sort(key=lambda i: -balances[i])
+    debtors.sort(key=lambda i: balances[i])
+    remaining = list(balances)
+
+    transfers = list()
+    x = y = 0
+    while x < len(debtors) and y < len(creditors):
+        debtor, creditor = debtors[x], creditors[y]
+        debtor_amount, creditor_amount = -remaining[debtor], remaining[creditor]
+
+        # Determine the amount to transfer
+        transfer_amount = min(debtor_amount, creditor_amount)
+        transfers.append((debtor, creditor, transfer_amount))
+
+        # Update the balances and advance whoever is exhausted
+        remaining[debtor] += transfer_amount
+        remaining[creditor] -= transfer_amount
+        if debtor_amount <= creditor_amount:
+            x += 1
+        if creditor_amount <= debtor_amount:
+            y += 1
+
+    return transfers
+
+def zero_sum_groups(amounts: list) -> list:
+    # Partitions integer amounts summing to zero into the most groups that each sum to zero,
+    # as lists of indices. n people in k groups settle in n - k transactions, the fewest possible
+    n = len(amounts)
+    full = (1 << n) - 1
+    totals = [0] * (1 << n)
+    # best[mask]: most zero-sum groups the people in mask can be split into, counted along
+    # an order of removing them one at a time
+    best = [0] * (1 << n)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        totals[mask] = totals[mask ^ low] + amounts[low.bit_length() - 1]
+        best[mask] = max(best[mask ^ (1 << i)] for i in range(n) if mask >> i & 1) + (totals[mask] == 0)
+
+    # Walk back down from everyone, closing a group whenever the people left sum to zero
+    groups = list()
+    group = list()
+    mask = full
+    while mask:
+        gain = totals[mask] == 0
+        i = next(i for i in range(n) if mask >> i & 1 and best[mask ^ (1 << i)] + gain == best[mask])
+        group.append(i)
+        mask ^= 1 << i
+        if totals[mask] == 0:
+            groups.append(group)
+            group = list()
+
+    return groups
+
+class AddError(ValueError):
+    # Raised by parse_add, carrying the reply to send back
+    pass
+
+def parse_add(args: list, users) -> tuple:
+    # Validates "/add @person value @other..." against the included users and returns
+    # (person, value in cents, others or None)
+    if not users:
+        raise AddError("Error: Please use the /include command to add users first!")
+
+    # Included users are always valid handles, so one subset test covers the format too
+    if len(args) < 2 or not users.keys() >= {args[0], *args[2:]}:
+        raise AddError("Error: the format should be '/add @name value @other1 @other2...'. Only specify users you've added using /include!")
+
+    person, value, *others = args
+    if not is_amount(value): # non-numeric value found as expense argument
+        raise AddError("Error: non-numeric value for expense found.")
+
+    # Checked on the text so nothing is rounded away; trailing zeros are harmless
+    if len(value.partition('.')[2].rstrip('0')) > 2:
+        raise AddError("Error: expenses can have at most 2 decimal places.")
+
+    # Decimal parses the text exactly, so the conversion to cents is exact too
+    amount = Decimal(value)
+    if amount > _MAX_AMOUNT:
+        raise AddError(f"Error: expenses can be at most {_MAX_AMOUNT}.")
+
+    return person, int(amount * 100), others or None
+
+def chunk_message(text: str, size: int = 4000) -> list:
+    # Splits text on line boundaries into pieces under Telegram's 4096 character limit
+    chunks = list()
+    pieces = list()
+    length = 0
+    for line in text.splitlines(keepends=True):
+        # Lines longer than size on their own are cut hard
+        for start in range(0, len(line), size):
+            piece = line[start:start + size]
+            if length + len(piece) > size:
+                chunks.append(''.join(pieces))
+                pieces.clear()
+                length = 0
+            pieces.append(piece)
+            length += len(piece)
+
+    if pieces:
+        chunks.append(''.join(pieces))
+
+    # Telegram rejects whitespace-only messages, e.g. a lone "\n" left by a hard cut
+    return [chunk for chunk in chunks if not chunk.isspace()]
 
 # ====================================================
 
@@ -264,23 +354,18 @@ if __name__ == '__main__':
     load_dotenv()
     TOKEN = os.environ['BOT_TOKEN']
 
-    # Build application
+    # Build application, processing updates concurrently
     context_types = ContextTypes(chat_data=ChatData)
-    application = ApplicationBuilder().token(TOKEN).context_types(context_types).build()
+    application = ApplicationBuilder().token(TOKEN).context_types(context_types).concurrent_updates(True).build()
 
-    # Enable Logging
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    # Enable Logging, quiet by default (set LOG_LEVEL=INFO to see every update)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=os.environ.get('LOG_LEVEL', 'WARNING').upper())
     logger = logging.getLogger(__name__)
 
-    # Setup core-function handlers
-    start_handler = CommandHandler('start', start, filters=~filters.UpdateType.EDITED_MESSAGE)
-    include_handler = CommandHandler('include', include, filters=~filters.UpdateType.EDITED_MESSAGE)
-    help_handler = CommandHandler('help', help, filters=~filters.UpdateType.EDITED_MESSAGE)
-    add_handler = CommandHandler('add', add, filters=~filters.UpdateType.EDITED_MESSAGE)
-    view_handler = CommandHandler('view', view, filters=~filters.UpdateType.EDITED_MESSAGE)
-    resolve_handler = CommandHandler('resolve', resolve, filters=~filters.UpdateType.EDITED_MESSAGE)
-    clear_handler = CommandHandler('clear', clear, filters=~filters.UpdateType.EDITED_MESSAGE)
-    core_handlers = [start_handler, include_handler, help_handler, add_handler, view_handler, resolve_handler, clear_handler]
+    # Setup core-function handlers, all ignoring edited messages
+    non_edit = ~filters.UpdateType.EDITED_MESSAGE
+    core_commands = [('start', start), ('include', include), ('help', help), ('add', add), ('view', view), ('resolve', resolve), ('clear', clear)]
+    core_handlers = [CommandHandler(command, callback, filters=non_edit) for command, callback in core_commands]
 
     # Add core-function handlers
     application.add_handlers(core_handlers)
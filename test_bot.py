@@ -0,0 +1,43 @@
+import pytest
+
+from bot import AddError, chunk_message, parse_add
+
+
+def test_chunk_message_keeps_short_text_whole():
+    assert chunk_message("a\nb\n") == ["a\nb\n"]
+
+
+def test_chunk_message_splits_on_line_boundaries():
+    text = "a" * 3000 + "\n" + "b" * 3000 + "\n"
+    assert chunk_message(text) == ["a" * 3000 + "\n", "b" * 3000 + "\n"]
+
+
+def test_chunk_message_cuts_overlong_lines():
+    chunks = chunk_message("a" * 9000)
+    assert chunks == ["a" * 4000, "a" * 4000, "a" * 1000]
+
+
+def test_chunk_message_drops_trailing_newline_piece():
+    # A line of exactly size characters plus its newline must not leave a lone "\n" chunk
+    assert chunk_message("a" * 4000 + "\n") == ["a" * 4000]
+
+
+USERS = {"@a": 0, "@b": 0}
+
+
+@pytest.mark.parametrize("value, cents", [("10", 1000), ("0.28", 28), ("1.05", 105), (".5", 50), ("2.", 200), ("1.500", 150), ("1000000", 100000000)])
+def test_parse_add_converts_to_exact_cents(value, cents):
+    assert parse_add(["@a", value, "@b"], USERS) == ("@a", cents, ["@b"])
+
+
+@pytest.mark.parametrize("value", ["0.285", "1.005", "1" * 400, "1000000.01", "x", "-1"])
+def test_parse_add_rejects_bad_amounts(value):
+    with pytest.raises(AddError):
+        parse_add(["@a", value], USERS)
+
+
+def test_parse_add_requires_included_users():
+    with pytest.raises(AddError):
+        parse_add(["@a", "10"], {})
+    with pytest.raises(AddError):
+        parse_add(["@a", "10", "@c"], USERS)